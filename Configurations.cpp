@@ -28,6 +28,7 @@
 #include "bc/BC.hpp"
 #include "mpi.h"
 #include <cmath>
+#include <vector>
 
 using namespace espressopp;
 
@@ -331,6 +332,42 @@ void Configurations::gather()
     delete[] ids;
 }
 
+/** Coordinates or velocities of the particles first..first+n-1 of a stored configuration
+    packed as 3*n contiguous reals, so that Python can wrap them with np.frombuffer
+    instead of fetching one Real3D per particle */
+
+static boost::python::object packVectors(Configurations& self, int stackpos, int n, int first, bool vel)
+{
+    ConfigurationPtr config = self.get(stackpos);
+    if (!config)
+    {
+        // out of range or nothing gathered on this rank: fail instead of handing out zeros
+        PyErr_SetString(PyExc_IndexError, "Configurations: no configuration at this stack position");
+        boost::python::throw_error_already_set();
+    }
+    std::vector<real> buf(3 * n);
+    for (int i = 0; i < n; i++)
+    {
+        Real3D v = vel ? config->getVelocities(first + i) : config->getCoordinates(first + i);
+        buf[3 * i] = v[0];
+        buf[3 * i + 1] = v[1];
+        buf[3 * i + 2] = v[2];
+    }
+    PyObject* bytes =
+        PyBytes_FromStringAndSize(reinterpret_cast<const char*>(buf.data()), buf.size() * sizeof(real));
+    return boost::python::object(boost::python::handle<>(bytes));
+}
+
+static boost::python::object coordinateBytes(Configurations& self, int stackpos, int n, int first)
+{
+    return packVectors(self, stackpos, n, first, false);
+}
+
+static boost::python::object velocityBytes(Configurations& self, int stackpos, int n, int first)
+{
+    return packVectors(self, stackpos, n, first, true);
+}
+
 // Python wrapping
 
 void Configurations::registerPython()
@@ -348,6 +385,10 @@ void Configurations::registerPython()
         .def("__getitem__", &Configurations::get)
         .def("back", &Configurations::back)
         .def("all", &Configurations::all)
+        .def("coordinateBytes", &coordinateBytes,
+             (boost::python::arg("stackpos"), boost::python::arg("n"), boost::python::arg("first") = 0))
+        .def("velocityBytes", &velocityBytes,
+             (boost::python::arg("stackpos"), boost::python::arg("n"), boost::python::arg("first") = 0))
         .def("clear", &Configurations::clear);
 }
 }  // namespace analysis
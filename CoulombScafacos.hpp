@@ -98,6 +98,7 @@ private:
     int nParticles;   // local variable for the number of particles
     int num_glob;     // the total number of particles, input from arg/env
     bool ifBoundaryCross;
+    bool tuned = false;  // fcs_tune has been run on the current handle
     // parameters for shear flow
     real cottheta = .0;
     bool shear_flag = false;
@@ -319,6 +320,7 @@ public:
         // //masses = (fcs_float *) malloc (sizeof (fcs_float) * num_local);
 
         result = fcs_init(&handle, method.c_str(), communic);
+        tuned = false;
         // fcs_result_print_result (result);
         fcs_result_destroy(result);
         communic.barrier();
@@ -562,18 +564,16 @@ public:
 
             nlocal_map = k;
         }
-        if (1==0) //ifTuned)
+        // the mesh, charge assignment order and alpha only depend on the box and the charges,
+        // so they are tuned once per handle and reused; under shear the box tilt changes every step
+        if (tuned && !shear_flag)
         {
-            fcs_p3m_get_alpha(handle, &p3m_alpha);
-            fcs_p3m_get_r_cut(handle, &p3m_rcut);
-            fcs_p3m_get_cao(handle, &p3m_cao);
-            fcs_p3m_get_grid(handle, &p3m_grid);
-            // fcs_p3m_get_total_energy(handle,&tot_en);
-            // result=fcs_tune(handle, num_local, sfcs_coor, sfcs_cg);
+            result = NULL;
         }
         else
         {
             result = fcs_tune(handle, nlocal_map, sfcs_coor, sfcs_cg);
+            tuned = true;
             fcs_p3m_get_alpha(handle, &p3m_alpha);
             fcs_p3m_get_r_cut(handle, &p3m_rcut);
             fcs_p3m_get_cao(handle, &p3m_cao);
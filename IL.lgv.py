@@ -29,7 +29,6 @@ import time
 import espressopp
 import mpi4py.MPI as MPI
 import logging
-import random
 import numpy as np
 from scipy import constants
 from espressopp import Real3D, Int3D
@@ -37,41 +36,70 @@ from espressopp.tools import gromacs
 from espressopp.tools import decomp
 from espressopp.tools import timers
 import collections
+import itertools
+import shutil
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
 
-def write_gro(filename, system, typenames, time):
+# triclinic .gro box line (v1x v2y v3z v1y v1z v2x v2z v3x v3y), the shear offset goes to v3x
+BOX_FMT = "%.10g %.10g %.10g 0 0 0 0 %.10g 0\n"
+
+def write_gro(filename, conf, system, typenames, time, mode='w'):
     # only use for the CG model of BMIM-PF6
-    out_stream = open(filename, 'w')
-    out_stream.write("CG BMIM-PF6 t=" + str(time) + " \n")
+    # positions are gathered in one call into conf (a Configurations of capacity 1, created once)
+    # and fetched as one packed block of the pids 1..max_pid
+    conf.gather()
     max_pid = int(espressopp.analysis.MaxPID(system).compute())
+    pids = range(1, max_pid+1)
+    pos = np.frombuffer(conf.cxxobject.coordinateBytes(0, max_pid, 1), dtype=np.float64).reshape(max_pid, 3)
+
+    atomnames = np.asarray(typenames)[ptypes[:max_pid]]
+
+    lines = ["%5d%-5s%5s%5d%8.3f%8.3f%8.3f" % row for row in
+             zip(molids[:max_pid].tolist(), resnames_gro[:max_pid].tolist(), atomnames.tolist(), pids,
+                 pos[:,0].tolist(), pos[:,1].tolist(), pos[:,2].tolist())]
+
+    out_stream = open(filename, mode)
+    out_stream.write("CG BMIM-PF6 t=" + str(time) + " \n")
     out_stream.write(str(max_pid) + "\n")
-    
-    mol_num = 1
-    
-    for i in range(max_pid):
-        pid = i+1
-        particle = system.storage.getParticle(pid)
-        xpos   = particle.pos[0]
-        ypos   = particle.pos[1]
-        zpos   = particle.pos[2]
-        if particle.type != 4:
-            out_stream.write('{:>5}'.format(mol_num) + '{:<5}'.format("BMI") + '{:>5}'.format(typenames[particle.type]) 
-                             + '{:>5}'.format(pid) + '{:>8}'.format("%.3f"%(xpos)) 
-                             + '{:>8}'.format("%.3f"%(ypos)) + '{:>8}'.format("%.3f"%(zpos)) + '\n')
-            if particle.type == 3:
-                mol_num += 1
-        else: 
-            out_stream.write('{:>5}'.format(mol_num) + '{:<5}'.format("PF6") + '{:>5}'.format(typenames[particle.type]) 
-                             + '{:>5}'.format(pid) + '{:>8}'.format("%.3f"%(xpos)) 
-                             + '{:>8}'.format("%.3f"%(ypos)) + '{:>8}'.format("%.3f"%(zpos)) + '\n')
-            mol_num += 1 
-    out_stream.write(str(system.bc.boxL[0]) + ' ' + str(system.bc.boxL[1]) + ' ' + str(system.bc.boxL[2]) + ' ' +
-    str(0) + ' ' + str(0) + ' ' + str(0) + ' ' +
-    str(0) + ' ' + str(shear_rate*time*system.bc.boxL[0]) + ' ' + str(0)+"\n")
+    out_stream.write("\n".join(lines) + "\n")
+    boxL = system.bc.boxL
+    out_stream.write(BOX_FMT % (boxL[0], boxL[1], boxL[2], shear_rate*time*boxL[0]))
     out_stream.close()   
 
+# row format of out/energy.dat and the kJ/mol -> K conversion factor for T
+ENERGY_FMT = "%d" + " %.10g"*15 + " \n"
+T2K = 1000.0 / (constants.k * constants.N_A)
+
+def groupEnergy(interactions):
+    # total energy of a group of interactions (a tuple built once before the loop)
+    return sum(ia.computeEnergy() for ia in interactions)
+
+def energy_line(step, T, P, Pij, Etotal, Ek, Ep, EQQ, Eb, Ea, Ed):
+    # one row of out/energy.dat
+    return ENERGY_FMT % ((step, T*T2K, P) + tuple(Pij[k] for k in range(6)) + (Etotal, Ek, Ep, EQQ, Eb, Ea, Ed))
+
+def append_xtc(grofile, xtcfile):
+    # convert all frames of a multi-frame .gro with one trjconv call and append them to xtcfile;
+    # xtc frames are self-contained, so appending the bytes replaces gmx trjcat
+    tmpxtc = grofile.split(".")[0] + ".xtc"
+    try:
+        subprocess.run(["gmx_d", "trjconv", "-f", grofile, "-o", tmpxtc, "-quiet", "yes"], check=True)
+        with open(tmpxtc, 'rb') as src, open(xtcfile, 'ab') as dst:
+            shutil.copyfileobj(src, dst)
+    except (OSError, subprocess.CalledProcessError) as err:
+        # a failed conversion must not stop the MD; keep the .gro batch for converting it later
+        sys.stderr.write("append_xtc: could not convert %s, keeping it (%s)\n" % (grofile, err))
+        return
+    os.remove(grofile)
+    os.remove(tmpxtc)
+
 # simulation parameters (nvt = False is nve)
 rc    = 1.5  # Verlet list cutoff
 skin  = 0.3
+# rebuild-trigger skins tried before production, each for skin_tune_steps steps (empty list: no tuning)
+skin_tune_list  = [0.2, 0.3, 0.4, 0.5, 0.6]
+skin_tune_steps = 500
 timestep = 0.001
 tot_types= 5 # The total num of atomic types, 5 (0~4) in this case
 
@@ -83,6 +111,8 @@ equi_isteps = 50
 prod_nloops       = 20000 #2 ns
 # number of integration steps performed in each production loop
 prod_isteps       = 100
+# energies and pressures are computed and written every ener_nloops production loops
+ener_nloops       = 10
 
 # GROMACS tabulated potentials files
 tabCT_CTg = "table_CT_CT.xvg"    # non-bonded
@@ -144,6 +174,8 @@ topfile = "topology.top"
 
 def genTabPotentials(tabfilesnb):
     potentials = {}
+    # serial on purpose: the conversions are GIL-bound Python, and worker processes are unsafe here
+    # (MPI/PMI are already initialised, and spawned workers would re-run this script, it has no main guard)
     for fg in tabfilesnb:
         fe = fg.split(".")[0]+".tab" # name of espressopp file
         gromacs.convertTable(fg, fe, sigma, epsilon, c6, c12)
@@ -169,16 +201,19 @@ potentials = genTabPotentials(tabfilesnb)
 defaults, types, atomtypes, masses, charges, atomtypeparameters, bondtypes, bondtypeparams, angletypes, angletypeparams, exclusions, x, y, z, vx, vy, vz, resname, resid, Lx, Ly, Lz =gromacs.read(grofile,topfile)
 
 num_particles = len(x)
+
+# molecule numbers and residue names used by write_gro, the topology does not change during the run
+ptypes = np.asarray(types, dtype=np.int32)
+# a molecule ends after its CT (type 3) or PF (type 4) bead
+molend = (ptypes == 3) | (ptypes == 4)
+molids = np.cumsum(molend) - molend + 1
+resnames_gro = np.where(ptypes == 4, "PF6", "BMI")
+typenames_gro = np.array(["I1","I3","I2","CT","PF"])
 density = num_particles / (Lx * Ly * Lz)
 size = (Lx, Ly, Lz)
 
-# Create random seed
-tseed = int( time.time() * 1000.0 )
-random.seed( ((tseed & 0xff000000) >> 24) +
-             ((tseed & 0x00ff0000) >>  8) +
-             ((tseed & 0x0000ff00) <<  8) +
-             ((tseed & 0x000000ff) << 24)   )
-irand=random.randint(1,99999)
+# Create random seed (from the OS entropy pool, so jobs started in the same millisecond differ)
+irand = int.from_bytes(os.urandom(4), 'big') % 99999 + 1
 
 # Setup obj of system
 sys.stdout.write('Setting up simulation ...\n')
@@ -195,14 +230,18 @@ system.storage = espressopp.storage.DomainDecomposition(system, nodeGrid, cellGr
 
 # add particles to the system and then decompose
 props = ['id', 'pos', 'v', 'type', 'mass', 'q']
-allParticles = []
-for pid in range(num_particles):
-    part = [pid + 1, Real3D(x[pid], y[pid], z[pid]),
-            Real3D(vx[pid], vy[pid], vz[pid]), types[pid], masses[pid], charges[pid]]
-    allParticles.append(part)
+# positions and velocities as contiguous (N,3) arrays, zipped once with the per-particle properties
+pos = np.column_stack([x, y, z]).astype(np.float64)
+vel = np.column_stack([vx, vy, vz]).astype(np.float64)
+allParticles = [[pid, Real3D(*r), Real3D(*v), t, m, q] for pid, r, v, t, m, q in
+                zip(range(1, num_particles+1), pos.tolist(), vel.tolist(), types, masses, charges)]
 system.storage.addParticles(allParticles, *props)    
 system.storage.decompose()
 
+# configuration buffer reused by write_gro for every frame
+gro_conf = espressopp.analysis.Configurations(system)
+gro_conf.capacity = 1
+
 
 
 # Tabulated Verlet list for non-bonded interactions
@@ -227,32 +266,33 @@ rspacecutoff   = rc #3.0*pow(1/density,1.0/3.0) #  rspacecutoff - the cutoff in
 alphaEwald     = 2.885757 
 kspacecutoff   = 15 #  kspacecutoff - the cutoff in reciprocal space
 
-# Add Compensation terms first
+# type pairs that get a Coulomb potential: type 3 (CT) is skipped everywhere and
+# type 4 (PF) never appears in an excluded pair
+qq_types = [t for t in range(tot_types) if t != 3]
+excl_types = [t for t in range(tot_types-1) if t != 3]
+
+# excluded pairs for the compensation term
 fpl_excl=espressopp.FixedPairList(system.storage)
 fpl_excl.addBonds(exclusions)
+# Add Compensation terms first
 coulombR_potBonded = espressopp.interaction.CoulombMultiSiteCorrectionEwald(coulomb_prefactor, alphaEwald, rspacecutoff)
 coulombR_intBonded = espressopp.interaction.FixedPairListTypesCoulombMultiSiteCorrectionEwald(system,fpl_excl)
-for i in range(tot_types-1):
-  if i!=3:
-    for j in range(i, tot_types-1):
-      if j!=3:
-        coulombR_intBonded.setPotential(type1=i, type2=j, potential=coulombR_potBonded)
+for t1, t2 in itertools.combinations_with_replacement(excl_types, 2):
+  coulombR_intBonded.setPotential(type1=t1, type2=t2, potential=coulombR_potBonded)
 system.addInteraction(coulombR_intBonded) # cancelling self energies for interatomic interactions
 
 coulombR_potEwald = espressopp.interaction.CoulombRSpace(coulomb_prefactor, alphaEwald, rspacecutoff)
 coulombR_intEwald = espressopp.interaction.VerletListCoulombRSpace(vl)
-for i in range(tot_types):
-  if i!=3:
-    for j in range(i, tot_types):
-      if j!=3:
-        #print "I-J: ",i,j
-        coulombR_intEwald.setPotential(type1=i, type2=j, potential = coulombR_potEwald)
+for t1, t2 in itertools.combinations_with_replacement(qq_types, 2):
+  coulombR_intEwald.setPotential(type1=t1, type2=t2, potential = coulombR_potEwald)
 system.addInteraction(coulombR_intEwald)
 
 coulombK_potEwald = espressopp.interaction.CoulombKSpaceEwald(system, coulomb_prefactor, alphaEwald, kspacecutoff)
 coulombK_intEwald = espressopp.interaction.CellListCoulombKSpaceEwald(system.storage, coulombK_potEwald)
 system.addInteraction(coulombK_intEwald)
 
+qq_interactions = (coulombR_intBonded, coulombR_intEwald, coulombK_intEwald)
+
 
 # bonded 2-body interactions
 bondedinteractions=gromacs.setBondedInteractions(system, bondtypes, bondtypeparams)
@@ -343,6 +383,26 @@ for step in range(equi_nloops):
   integrator.run(equi_isteps)
   espressopp.tools.analyse.info(system, integrator)
 print("equilibration finished")
+
+# The Verlet list keeps the pair cutoff it was built with (rc + 2*skin, the skin is added once
+# more inside VerletList), while rebuilds are triggered once a particle moved by system.skin/2.
+# A trigger skin must stay within that list cutoff and the cells must stay at least rc+skin wide;
+# decomp.cellGrid only guarantees the latter for the original skin, so candidates are capped at
+# the actual cell width minus rc. Pick the one with the shortest run time.
+cell_width = min(size[d] / (nodeGrid[d] * cellGrid[d]) for d in range(3))
+max_tune_skin = min(2*skin, cell_width - rc)
+tune_skins = [s for s in skin_tune_list if s <= max_tune_skin]
+if tune_skins:
+  tune_times = []
+  for s in tune_skins:
+    system.skin = s
+    builds = vl.builds
+    t0 = time.time()
+    integrator.run(skin_tune_steps)
+    tune_times.append(time.time() - t0)
+    print("skin tuning: skin = %.3f  time = %.3f s  rebuilds = %d" % (s, tune_times[-1], vl.builds - builds))
+  system.skin = tune_skins[int(np.argmin(tune_times))]
+  print("skin tuning: using skin =", system.skin)
 integrator.resetTimers()
 
 fmt = '%5d %8.4f %11.4f %11.4f %12.3f %12.3f %12.3f %12.3f %12.3f %12.3f %12.3f\n'
@@ -352,13 +412,15 @@ T = temperature.compute()
 P = 0
 #Pij = pressureTensor.compute()
 Pij = [0,0,0,0,0,0]
-Ek = 0.5 * T * (3 * num_particles)
+ndof = 3 * num_particles
+Ek = 0.5 * T * ndof
 Ep = internb.computeEnergy()
-Eb, Ea, Ed=0,0,0
-for bd in bondedinteractions.values():Eb+=bd.computeEnergy()
-for ang in angleinteractions.values(): Ea+=ang.computeEnergy()
+# the interaction dicts do not change during the run
+bonded_list = tuple(bondedinteractions.values())
+angle_list = tuple(angleinteractions.values())
+Eb, Ea, Ed=groupEnergy(bonded_list),groupEnergy(angle_list),0
 #for dih in dihedralinteractions.values(): Ed+=dih.computeEnergy()
-EQQ= coulombR_intBonded.computeEnergy()+coulombR_intEwald.computeEnergy()+coulombK_intEwald.computeEnergy()
+EQQ= groupEnergy(qq_interactions)
 
 Etotal = Ek + Ep + EQQ + Eb + Ea + Ed
 sys.stdout.write(' step     T          P          Pxy        etotal      ekinetic      epair         ecoul         ebond       eangle       edihedral\n')
@@ -377,12 +439,18 @@ integrator2.addExtension(langevin)
 # to speed up verlet list builds should be adjusted accordingly 
 #system.storage.cellAdjust()
 
-first_traj = True
-os.system("mkdir -p out")
+os.makedirs("out", exist_ok=True)
+for f in ["out/traj.xtc", "out/frames.gro"]:
+    if os.path.exists(f):
+        os.remove(f)
 out_energy = open("out/energy.dat", 'w')
 out_energy.write(' step T P Pxx Pyy Pzz Pxy Pxz Pyz etotal ekinetic epair ecoul ebond eangle edihedral\n')
-out_energy.write(str(0) + " " + str(T/constants.k/constants.N_A*1000) + " " +  str(P) + " " +  str(Pij[0]) + " " +  str(Pij[1]) + " " +  str(Pij[2]) + " " +  str(Pij[3]) + " " +  str(Pij[4]) + " " +  str(Pij[5]) + " " +  str(Etotal) + " " +  str(Ek) + " " +  str(Ep) + " " +  str(EQQ) + " " +  str(Eb) + " " +  str(Ea) + " " +  str(Ed) + " \n")
+out_energy.write(energy_line(0, T, P, Pij, Etotal, Ek, Ep, EQQ, Eb, Ea, Ed))
+
 
+# trajectory batches are converted by one background thread (in order) while the MD keeps running
+xtc_writer = ThreadPoolExecutor(max_workers=1)
+xtc_future = None
 
 print("starting production ...")
 start_time = time.process_time()
@@ -392,43 +460,43 @@ start_time = time.process_time()
 for i in range(prod_nloops):
 
     integrator2.run(prod_isteps) # print out every steps/check steps
-    T = temperature.compute()
-    P = pressure.compute()
-    Pij = pressureTensor.compute()
-    Ek = 0.5 * T * (3 * num_particles)
-    Ep = internb.computeEnergy()
-    EQQ= coulombR_intBonded.computeEnergy()+coulombR_intEwald.computeEnergy()+coulombK_intEwald.computeEnergy()
-        
-    Eb, Ea, Ed=0,0,0
-    for bd in bondedinteractions.values():Eb+=bd.computeEnergy()
-    for ang in angleinteractions.values(): Ea+=ang.computeEnergy()
-    #for dih in dihedralinteractions.values(): Ed+=dih.computeEnergy()
-    Etotal = Ek + Ep + EQQ + Eb + Ea + Ed
-    sys.stdout.write(fmt % ((i+1)*(prod_isteps), T, P, Pij[3], Etotal, Ek, Ep, EQQ, Eb, Ea, Ed))
-    out_energy.write(str((i+1)*(prod_isteps)) + " " + str(T/constants.k/constants.N_A*1000) + " " +  str(P) + " " +  str(Pij[0]) + " " +  str(Pij[1]) + " " +  str(Pij[2]) + " " +  str(Pij[3]) + " " +  str(Pij[4]) + " " +  str(Pij[5]) + " " +  str(Etotal) + " " +  str(Ek) + " " +  str(Ep) + " " +  str(EQQ) + " " +  str(Eb) + " " +  str(Ea) + " " +  str(Ed) + " \n")
+    if (i+1)%ener_nloops == 0:
+        T = temperature.compute()
+        P = pressure.compute()
+        Pij = pressureTensor.compute()
+        Ek = 0.5 * T * ndof
+        Ep = internb.computeEnergy()
+        EQQ= groupEnergy(qq_interactions)
+
+        Eb, Ea, Ed=groupEnergy(bonded_list),groupEnergy(angle_list),0
+        #for dih in dihedralinteractions.values(): Ed+=dih.computeEnergy()
+        Etotal = Ek + Ep + EQQ + Eb + Ea + Ed
+        sys.stdout.write(fmt % ((i+1)*(prod_isteps), T, P, Pij[3], Etotal, Ek, Ep, EQQ, Eb, Ea, Ed))
+        out_energy.write(energy_line((i+1)*(prod_isteps), T, P, Pij, Etotal, Ek, Ep, EQQ, Eb, Ea, Ed))
 
     #espressopp.tools.pdb.pdbwrite("traj.pdb", system, append=True, typenames={0:'O', 1:'N', 2:'C', 3:'S', 4:'P'})
     #sys.stdout.write('\n')
-    write_gro("out/out_" + str(integrator2.step).zfill(12) + ".gro", system, 
-              ["I1","I3","I2","CT","PF"], integrator2.step * timestep)
+    # all frames go to one multi-frame .gro, converted in a single trjconv call every 1000 loops
+    write_gro("out/frames.gro", gro_conf, system, 
+              typenames_gro, integrator2.step * timestep, mode='a')
     
     if i%1000 == 0:
-        os.system("for d in out/out_*.gro; do gmx_d trjconv -f $d -o ${d%.*}.xtc -quiet yes; done")
-        if first_traj == True:
-            os.system("gmx_d trjcat -f out/out_*.xtc -o out/traj.xtc -quiet yes")
-            first_traj = False
-        else:
-            os.system("gmx_d trjcat -f out/out_*.xtc out/traj.xtc -o out/traj.xtc -quiet yes -nobackup")
-        os.system("rm out/out_*.gro") 
-        os.system("rm out/out_*.xtc") 
-        out_energy.close()
-        out_energy = open("out/energy.dat", 'a')       
+        # hand the finished batch to the background converter, MD continues with a new frames.gro
+        batch_gro = "out/frames_%d.gro" % (i // 1000)
+        os.rename("out/frames.gro", batch_gro)
+        if xtc_future is not None:
+            xtc_future.result()
+        xtc_future = xtc_writer.submit(append_xtc, batch_gro, "out/traj.xtc")
+        out_energy.flush()
     
-os.system("for d in out/out_*.gro; do gmx_d trjconv -f $d -o ${d%.*}.xtc -quiet yes; done")
-os.system("gmx_d trjcat -f out/out_*.xtc out/traj.xtc -o out/traj.xtc -quiet yes -nobackup")
-os.system("echo 0 | gmx_d trjconv -f out/traj.xtc -s start.gro -o out/traj_nojump.xtc -pbc nojump -quiet yes")
-os.system("rm out/out_*.gro") 
-os.system("rm out/out_*.xtc") 
+xtc_writer.shutdown(wait=True)
+if os.path.exists("out/frames.gro"):
+    append_xtc("out/frames.gro", "out/traj.xtc")
+try:
+    subprocess.run(["gmx_d", "trjconv", "-f", "out/traj.xtc", "-s", "start.gro", "-o", "out/traj_nojump.xtc",
+                    "-pbc", "nojump", "-quiet", "yes"], input=b"0\n")
+except OSError as err:
+    sys.stderr.write("nojump conversion of out/traj.xtc failed (%s)\n" % err)
 out_energy.close()
 # print timings and neighbor list information
 end_time = time.process_time()
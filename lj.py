@@ -58,12 +58,24 @@ The simulation consists of the following steps:
 import espressopp
 import time
 import sys
-import random
-import math
+import secrets
 import numpy as np
 from espressopp.tools import decomp, timers, replicate
 import os
 
+def confArray(confs, stackpos, a=None, velocities=False):
+  # (Npart,3) numpy array of the positions (or velocities) of a gathered configuration,
+  # row k holds particle k; copied in one block from the packed buffer of the C++ side
+  # (filled into a if given)
+  if velocities:
+    buf=confs.cxxobject.velocityBytes(stackpos, Npart)
+  else:
+    buf=confs.cxxobject.coordinateBytes(stackpos, Npart)
+  if a is None:
+    a=np.empty((Npart,3))
+  a[:]=np.frombuffer(buf, dtype=np.float64).reshape(Npart,3)
+  return a
+
 ########################################################################
 # 1. specification of the main simulation parameters                   #
 ########################################################################
@@ -125,6 +137,10 @@ equil_isteps       = 100
 prod_nloops       = 50000
 # number of integration steps performed in each production loop
 prod_isteps       = 100
+# number of production loops between flushes of the buffered MSD/profile output
+flush_nloops      = 100
+# number of production loops between analyse.info status lines
+info_nloops       = 100
 
 # print ESPResSo++ version and compile info
 print(espressopp.Version().info())
@@ -149,13 +165,9 @@ print("capradius          = ", capradius)
 print("equil_nloops       = ", equil_nloops)
 print("equil_isteps       = ", equil_isteps)
 
-# Create random seed
-tseed = int( time.time() * 1000.0 )
-random.seed( ((tseed & 0xff000000) >> 24) +
-             ((tseed & 0x00ff0000) >>  8) +
-             ((tseed & 0x0000ff00) <<  8) +
-             ((tseed & 0x000000ff) << 24)   )
-irand=random.randint(1,99999)
+# Create random seed in [1,99999], or take it from the SEED environment variable to reproduce a run
+irand=int(os.environ.get("SEED") or secrets.randbelow(99999)+1)
+print("irand              = ", irand)
 
 ########################################################################
 # 2. setup of the system, random number geneartor and parallelisation  #
@@ -198,15 +210,18 @@ print("adding ", Npart, " particles to the system ...")
 ## create a particel group that will contain the fixed particles
 #fixedWall  = espressopp.ParticleGroup(system.storage)
 
-for pid in range(Npart):
-  # get a 3D random coordinate within the box
-  pos = system.bc.getRandomPos()
-  # add a particle with particle id pid and coordinate pos to the system
-  # coordinates are automatically folded according to periodic boundary conditions
-  # the following default values are set for each particle:
-  # (type=0, mass=1.0, velocity=(0,0,0), charge=0.0)
-  system.storage.addParticle(pid, pos)
-  #fixedWall.add(pid)
+# every particle gets a 3D random coordinate within the box
+# coordinates are automatically folded according to periodic boundary conditions
+# the following default values are set for each particle:
+# (type=0, mass=1.0, velocity=(0,0,0), charge=0.0)
+props        = ['id', 'pos']
+# draw all random coordinates at once, seeded with the same irand as system.rng
+ppos         = np.random.default_rng(irand).uniform(low=0.0, high=box, size=(Npart, 3))
+allParticles = [[pid, espressopp.Real3D(*r)] for pid, r in enumerate(ppos.tolist())]
+# add all particles to the system with a single call
+system.storage.addParticles(allParticles, *props)
+#for pid in range(Npart):
+#  fixedWall.add(pid)
 # distribute the particles to parallel CPUs 
 system.storage.decompose()
 
@@ -268,6 +283,7 @@ for step in range(warmup_nloops):
   # decrease force capping radius in the potential
   LJpot.epsilon += epsilon_delta
   # update the type0-type0 interaction to use the new values of LJpot
+  # (setPotential stores a copy, so changing LJpot alone does not reach the interaction)
   interaction.setPotential(type1=0, type2=0, potential=LJpot)
   # print status info
   espressopp.tools.analyse.info(system, integrator) 
@@ -381,18 +397,39 @@ filename = "prod.xyz"
 conf  = espressopp.analysis.Configurations(system)
 conf.capacity=2
 conf.gather()
-vel = espressopp.analysis.Velocities(system)
+# newest snapshot as an (Npart,3) array, it becomes the previous one after the next gather
+p0=confArray(conf, 0)
+p1=np.empty_like(p0)
+# velocity-only gather, so that the velocities can be fetched with velocityBytes as well
+vel = espressopp.analysis.Configurations(system, pos=False, vel=True)
 vel.capacity=1
 vel.gather()
 
-dpl=(0.0,0.0,0.0)
-dpl=dpl*Npart
-dpl=list(dpl)
+# accumulated (unwrapped) displacement of each particle
+dpl=np.zeros((Npart,3))
 
 zbin=50
 dz=Lz/float(zbin)
 zvol=dz*Lx*Ly
 
+# loop invariants of the production analysis
+halfLz=0.5*Lz
+inv_Lx=1.0/Lx
+inv_Ly=1.0/Ly
+inv_Lz=1.0/Lz
+inv_dz=1.0/dz
+inv_N=1.0/Npart
+inv_zvolrho=1.0/(zvol*rho)
+zpos=(np.arange(zbin)+0.5)/zbin
+
+# analysis output lines, written to stdout every flush_nloops loops
+outbuf=[]
+
+# per-step work arrays, reused across the production loop
+l=np.empty((Npart,3))
+v0=np.empty((Npart,3))
+vx=np.zeros(zbin)
+
 tstart=time.process_time()
 rstep=int(99.0*prod_nloops) #report after simulation run by 80%
 for step in range(prod_nloops+1):
@@ -404,80 +441,65 @@ for step in range(prod_nloops+1):
     vel.gather()
     
     # calculate MSD
-    msd=0.0
-    msy=0.0
-    msz=0.0
-    for k in range(Npart):
-      l=conf[0][k]-conf[1][k]
-      if l[2]<-Lz/2.0:
-        l[2]+=Lz
-        l[0]+=system.shearOffset
-      elif l[2]>Lz/2.0:
-        l[2]-=Lz
-        l[0]-=system.shearOffset
-      if l[1]<-Ly/2.0:
-        l[1]+=Ly
-      elif l[1]>Ly/2.0:
-        l[1]-=Ly
-      if l[0]<-Lx/2.0:
-        while l[0]<-Lx/2.0:
-          l[0]+=Lx
-      elif l[0]>Lx/2.0:
-        while l[0]>Lx/2.0:
-          l[0]-=Lx
-      for i in range(1,3):
-        dpl[k*3+i]+=l[i]
-        msd+=dpl[k*3+i]*dpl[k*3+i]
-        if i==1:
-          msy+=dpl[k*3+i]*dpl[k*3+i]
-        elif i==2:
-          msz+=dpl[k*3+i]*dpl[k*3+i]
-    print("MSD> %.3f %.6f" %(step*dt*prod_isteps,msd/float(Npart)))
-    print("MSY> %.3f %.6f" %(step*dt*prod_isteps,msy/float(Npart)))
-    print("MSZ> %.3f %.6f" %(step*dt*prod_isteps,msz/float(Npart)))
+    p0,p1=p1,p0
+    confArray(conf, 0, p0)
+    # minimum image of the displacement since the last gather, crossing z shifts x by the shear offset
+    np.subtract(p0,p1,out=l)
+    nz=np.round(l[:,2]*inv_Lz)
+    l[:,2]-=nz*Lz
+    l[:,0]-=nz*system.shearOffset
+    l[:,1]-=np.round(l[:,1]*inv_Ly)*Ly
+    l[:,0]-=np.round(l[:,0]*inv_Lx)*Lx
+    dpl[:,1:]+=l[:,1:]
+    msy,msz=(dpl[:,1:]**2).sum(axis=0)
+    msd=msy+msz
+    tnow=step*dt*prod_isteps
+    outbuf.append("MSD> %.3f %.6f\n" %(tnow,msd*inv_N))
+    outbuf.append("MSY> %.3f %.6f\n" %(tnow,msy*inv_N))
+    outbuf.append("MSZ> %.3f %.6f\n" %(tnow,msz*inv_N))
     
     if step>=rstep:
       # calculate z-layer profiles
-      znum=[0]*zbin
-      tempy=[.0]*zbin
-      tempz=[.0]*zbin
-      vx=[.0]*zbin
-      zrho=[.0]*zbin
-      for k in range(Npart):
-        zi=math.floor(conf[0][k][2]/dz)
-        if zi>zbin-1:
-          zi=zbin-1
-        vshear=shear_rate*(conf[0][k][2]-Lz/2.0)
-        znum[zi]+=1
-        if shear_rate > .0:
-          vx[zi]+=vel[0][k][0]+vshear
-        tempy[zi]+=vel[0][k][1]*vel[0][k][1]
-        tempz[zi]+=vel[0][k][2]*vel[0][k][2]
+      confArray(vel, 0, v0, velocities=True)
+      # folded z is non-negative, so truncation equals floor
+      zi=(p0[:,2]*inv_dz).astype(np.intp)
+      np.clip(zi,0,zbin-1,out=zi)
+      znum=np.bincount(zi,minlength=zbin)
+      tempy=np.bincount(zi,weights=v0[:,1]**2,minlength=zbin)
+      tempz=np.bincount(zi,weights=v0[:,2]**2,minlength=zbin)
+      if shear_rate > .0:
+        vx=np.bincount(zi,weights=v0[:,0]+shear_rate*(p0[:,2]-halfLz),minlength=zbin)
       
+      # normalize the occupied bins only, empty bins stay zero
+      occ=znum>0
+      tempy[occ]/=znum[occ]
+      tempz[occ]/=znum[occ]
+      if shear_rate > .0:
+        vx[occ]/=znum[occ]*shear_rate*halfLz
+      zrho=znum*inv_zvolrho
       for z in range(zbin):
-        if znum[z]>0:
-          tempy[z]/=float(znum[z])
-          tempz[z]/=float(znum[z])
-          if shear_rate > .0:
-            vx[z]/=float(znum[z])*shear_rate*Lz/2.0
-          zrho[z]=znum[z]/zvol/rho
-        
-        zpos=float(z+0.5)/float(zbin)
-        print("TY> %.3f %.6f" %(zpos,tempy[z]))
-        print("TZ> %.3f %.6f" %(zpos,tempz[z]))
-        print("VX> %.3f %.6f" %(zpos,vx[z]))
-        print("DENSITY> %.3f %.6f" %(zpos,zrho[z]))
+        outbuf.append("TY> %.3f %.6f\n" %(zpos[z],tempy[z]))
+        outbuf.append("TZ> %.3f %.6f\n" %(zpos[z],tempz[z]))
+        outbuf.append("VX> %.3f %.6f\n" %(zpos[z],vx[z]))
+        outbuf.append("DENSITY> %.3f %.6f\n" %(zpos[z],zrho[z]))
     
     # print shear viscosity
-    print("SIGXZ> %d %.6f" % (step*prod_isteps,system.sumP_xz))
+    outbuf.append("SIGXZ> %d %.6f\n" % (step*prod_isteps,system.sumP_xz))
+    if step%flush_nloops==0:
+      sys.stdout.write("".join(outbuf))
+      sys.stdout.flush()
+      outbuf.clear()
   
   # print status information
   #espressopp.tools.vmd.imd_positions(system, sock)
-  espressopp.tools.analyse.info(system, integrator2)
+  if step%info_nloops==0:
+    espressopp.tools.analyse.info(system, integrator2)
   #espressopp.tools.writexyz(filename, system, velocities = False, unfolded = False, append=True)
   #espressopp.tools.fastwritexyz(filename, system, velocities = False, unfolded = False, append=True, scale=1.0)
   #espressopp.tools.xyzfilewrite(filename, system, velocities = False, charge = False, append=True, atomtypes={0:'X'})
 
+sys.stdout.write("".join(outbuf))
+outbuf.clear()
 print("WALLTIME= ",time.process_time()-tstart)
 print("production finished")
 
@@ -40,17 +40,49 @@ Usage:
 """
 
 import sys
+import gc
 import time
 import espressopp
 import mpi4py.MPI as MPI
 import logging
 import numpy as np
+from scipy.optimize import brentq
+from scipy.special import erfc
 from espressopp import Real3D, Int3D
 from espressopp.tools import gromacs
 from espressopp.tools import decomp
 from espressopp.tools import timers
 #from espressopp.tools.units import *
 
+def balancedNodeGrid(n, box, rc, skin, pos, min_gain=0.1):
+    # regular node grid for n ranks, chosen by the particle count of the busiest subdomain
+    # (only grids whose subdomains are at least rc+skin wide). decomp.nodeGrid's choice is kept
+    # unless another grid lowers that count by more than min_gain; among those, the ghost surface
+    # of a subdomain breaks near-ties, so statistical noise does not pick a slab decomposition
+    def load(g):
+        idx = tuple(np.minimum((np.mod(pos[:,d], box[d])*(g[d]/box[d])).astype(np.intp), g[d]-1) for d in range(3))
+        return np.bincount(np.ravel_multi_index(idx, g), minlength=g[0]*g[1]*g[2]).max()
+    def surface(g):
+        a = [box[d]/g[d] for d in range(3)]
+        return a[0]*a[1] + a[1]*a[2] + a[0]*a[2]
+    dflt = decomp.nodeGrid(n, box, rc, skin)
+    dflt = (int(dflt[0]), int(dflt[1]), int(dflt[2]))
+    maxload = (1.0 - min_gain) * load(dflt)
+    best, bestcost = dflt, None
+    for nx in range(1, n+1):
+        if n % nx: continue
+        for ny in range(1, n//nx+1):
+            if (n//nx) % ny: continue
+            g = (nx, ny, n//nx//ny)
+            if any(box[d]/g[d] < rc+skin for d in range(3)): continue
+            l = load(g)
+            if l >= maxload: continue
+            # loads within 1% of each other count as equal, the smaller surface wins
+            cost = (round(l / maxload, 2), surface(g))
+            if bestcost is None or cost < bestcost:
+                best, bestcost = g, cost
+    return Int3D(*best)
+
 kB  = 1.3806488 * pow(10,-23) # m^2 * kg * s^-2 * K^-1
 Na  = 6.0221413 * pow(10, 23) # mol^-1
 amu = 1.6605389 * pow(10,-27)
@@ -63,6 +95,8 @@ shear_rate = 0.0
 EMODE=2# 0: generalized reaction field / 1: Ewald (internal) / 2: Scafacos
 steps = 1000
 check = steps/5
+analysis_every = 1 # compute and print energies every analysis_every checks
+flush_every = 10 # write the buffered energy rows every flush_every checks
 rc    = 0.9  # Verlet list cutoff
 skin  = 0.03 
 timestep = 0.0005
@@ -80,6 +114,9 @@ topfile = "topol.top"
 # The variables at the beginning defaults, types, etc... can be found by calling
 # gromacs.read(grofile,topfile) without return values. It then prints out the variables to be unpacked
 defaults, types, atomtypes, masses, charges, atomtypeparameters, bondtypes, bondtypeparams, angletypes, angletypeparams, exclusions, x, y, z, vx, vy, vz, resname, resid, Lx, Ly, Lz =gromacs.read(grofile,topfile)
+# positions and velocities as contiguous (N,3) arrays, used for the decomposition and the particle setup
+pos = np.column_stack([x, y, z]).astype(np.float64)
+vel = np.column_stack([vx, vy, vz]).astype(np.float64)
 
 ######################################################################
 ##  IT SHOULD BE UNNECESSARY TO MAKE MODIFICATIONS BELOW THIS LINE  ##
@@ -87,10 +124,11 @@ defaults, types, atomtypes, masses, charges, atomtypeparameters, bondtypes, bond
 #types, bonds, angles, dihedrals, x, y, z, vx, vy, vz, Lx, Ly, Lz = gromacs.read(grofile,topfile)
 #defaults, types, masses, charges, atomtypeparameters, bondtypes, bondtypeparams, angletypes, angletypeparams, exclusions, x, y, z, vx, vy, vz, Lx, Ly, Lz = gromacs.read(grofile,topfile)
 
-num_particles = len(x)
+num_particles = pos.shape[0]
 
-density = num_particles / (Lx * Ly * Lz)
 size = (Lx, Ly, Lz)
+volume = Lx * Ly * Lz
+density = num_particles / volume
 print('Box size: ',size)
 
 sys.stdout.write('Setting up simulation ...\n')
@@ -100,20 +138,23 @@ system.bc = espressopp.bc.OrthorhombicBC(system.rng, size)
 system.skin = skin
 
 comm = MPI.COMM_WORLD
-nodeGrid = decomp.nodeGrid(comm.size,size,rc,skin)
+# pick the node grid from the actual particle distribution rather than assuming uniform density
+nodeGrid = balancedNodeGrid(comm.size, size, rc, skin, pos)
 cellGrid = decomp.cellGrid(size, nodeGrid, rc, skin)
 system.storage = espressopp.storage.DomainDecomposition(system, nodeGrid, cellGrid)
 
 
 # add particles to the system and then decompose
 props = ['id', 'pos', 'v', 'type', 'mass', 'q']
-allParticles = []
-for pid in range(num_particles):
-	part = [pid + 1, Real3D(x[pid], y[pid], z[pid]),
-			Real3D(vx[pid], vy[pid], vz[pid]), types[pid], masses[pid], charges[pid]]
-	allParticles.append(part)
+# zip the position/velocity rows once with the per-particle properties
+allParticles = [[pid, Real3D(*r), Real3D(*v), t, m, q] for pid, r, v, t, m, q in
+                zip(range(1, num_particles+1), pos.tolist(), vel.tolist(), types, masses, charges)]
 system.storage.addParticles(allParticles, *props)    
 system.storage.decompose()
+# the particle data now lives in the storage; drop the parsed per-particle lists
+# (types is kept for setCoulombInteractions)
+del allParticles, pos, vel, x, y, z, vx, vy, vz, masses, charges, resname, resid
+gc.collect()
 
 #espressopp.tools.pdb.pdbwrite('input.pdb', system, append=False)
 #print(types)
@@ -145,6 +186,14 @@ elif EMODE>0:
     rspacecutoff   = 0.9 #  rspacecutoff - the cutoff in real space
     alphaEwald     = 2.45399
     kspacecutoff   = 30 #  kspacecutoff - the cutoff in reciprocal space
+    if EMODE==1:
+        ewald_tolerance = 1e-5 # relative truncation error of both the real and reciprocal space sums
+        # balance the two sums: alpha such that erfc(alpha*rc) hits the tolerance, then the smallest
+        # reciprocal cutoff n with exp(-(pi*n/(alpha*L))^2) below the same tolerance
+        # (ScaFaCoS tunes its own alpha, so EMODE=2 keeps the fixed value above for its correction)
+        alphaEwald     = brentq(lambda a: erfc(a*rspacecutoff) - ewald_tolerance, 1e-3, 50.0/rspacecutoff)
+        kspacecutoff   = int(np.ceil(alphaEwald*max(size)*np.sqrt(-np.log(ewald_tolerance))/np.pi))
+        print('alphaEwald = %.5f, kspacecutoff = %d' % (alphaEwald, kspacecutoff))
 
     if EMODE>=1: #GO with Ewald in ESPR++
         # Add Compensation terms first
@@ -178,16 +227,22 @@ elif EMODE>0:
 langevin = espressopp.integrator.LangevinThermostat(system)
 langevin.gamma = 2.0
 langevin.temperature = 2.4942 # kT in gromacs units
-integrator = espressopp.integrator.VelocityVerlet(system)
-integrator.addExtension(langevin)
-integrator.dt = timestep
+if (shear_rate>0.0):
+  integrator2     = espressopp.integrator.VelocityVerletLE(system,shear=shear_rate,viscosity=False)
+else:
+  integrator2     = espressopp.integrator.VelocityVerlet(system)
+# set the integration step  
+integrator2.dt  = timestep
+integrator2.step = 0
+
+integrator2.addExtension(langevin)
 
 # print simulation parameters
 print('')
 print('number of particles =', num_particles)
 print('density = %.4f' % (density))
 print('rc =', rc)
-print('dt =', integrator.dt)
+print('dt =', integrator2.dt)
 print('skin =', system.skin)
 print('steps =', steps)
 print('NodeGrid = %s' % (nodeGrid,))
@@ -202,16 +257,6 @@ temperature = espressopp.analysis.Temperature(system)
 pressure = espressopp.analysis.Pressure(system)
 pressureTensor = espressopp.analysis.PressureTensor(system)
 
-if (shear_rate>0.0):
-  integrator2     = espressopp.integrator.VelocityVerletLE(system,shear=shear_rate,viscosity=False)
-else:
-  integrator2     = espressopp.integrator.VelocityVerlet(system)
-# set the integration step  
-integrator2.dt  = timestep
-integrator2.step = 0
-
-integrator2.addExtension(langevin)
-
 if shear_rate>0.0:
   system.storage.cellAdjust(shear = True)
 
@@ -220,29 +265,42 @@ fmt='%5.5f %15.8g %15.8g %15.8g %15.8g %15.8g %15.8f %15.8f\n'
 #outfile = open("esp.dat", "w")
 start_time = time.process_time()
 
-for i in range(int(check)):
-    T = temperature.compute()
-    P = pressure.compute()
-    Eb = 0
-    EAng = 0
-    for bd in list(bondedinteractions.values()): Eb+=bd.computeEnergy()
-    for ang in list(angleinteractions.values()): EAng+=ang.computeEnergy()
-    ELj= ljinteraction.computeEnergy()
-    if EMODE==0:
-        EQQ= qq_interactions.computeEnergy()
-    else:
-        EQQ=0.0
-    T = temperature.compute()
-    Ek = 0.5 * T * (3 * num_particles)
-    Etotal = Ek+Eb+EAng+EQQ+ELj
-    #outfile.write(fmt%(i*steps/check*timestep,Eb, EAng, ELj, EQQ, Ek, Etotal,T*T2Kalvin))
-    print(fmt%(i*steps/check*timestep,Eb, EAng, ELj, EQQ, Ek, Etotal,T*T2Kalvin))
+# reporting loop invariants
+bonded_vals = tuple(bondedinteractions.values())
+angle_vals = tuple(angleinteractions.values())
+n_check = int(check)
+n_sub = steps // n_check
+three_N = 3 * num_particles
+dt_per = n_sub * timestep
+# energy rows, written out every flush_every checks
+rows = []
+
+for i in range(n_check):
+    if i % analysis_every == 0:
+        T = temperature.compute()
+        Eb = sum(bd.computeEnergy() for bd in bonded_vals)
+        EAng = sum(ang.computeEnergy() for ang in angle_vals)
+        ELj= ljinteraction.computeEnergy()
+        if EMODE==0:
+            EQQ= qq_interactions.computeEnergy()
+        else:
+            EQQ=0.0
+        Ek = 0.5 * T * three_N
+        Etotal = Ek+Eb+EAng+EQQ+ELj
+        #outfile.write(fmt%(i*steps/check*timestep,Eb, EAng, ELj, EQQ, Ek, Etotal,T*T2Kalvin))
+        rows.append((i*dt_per,Eb, EAng, ELj, EQQ, Ek, Etotal,T*T2Kalvin))
+    if (i+1) % flush_every == 0:
+        sys.stdout.write(''.join(fmt%row for row in rows))
+        sys.stdout.flush()
+        rows.clear()
     #espressopp.tools.pdb.pdbwrite("traj.pdb", system, append=True)
-#    integrator.run(int(steps/check))
-    integrator2.run(int(steps/check))
+    integrator2.run(n_sub)
 
 # print timings and neighbor list information
 end_time = time.process_time()
+# leftover rows from the last partial batch
+sys.stdout.write(''.join(fmt%row for row in rows))
+sys.stdout.flush()
 timers.show(integrator2.getTimers(), precision=2)
 
 sys.stdout.write('Integration steps = %d\n' % integrator2.step)